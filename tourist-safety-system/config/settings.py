@@ -1,13 +1,20 @@
+import functools
 import platform
 import json
 import os
+import sys
+import types
 
 # --- 1. Environment Detection ---
 # Check if we are running on a Raspberry Pi or a Windows Laptop
-IS_RASPBERRY_PI = platform.system() == "Linux" and "aarch" in platform.machine()
-# Note: On a real Pi, platform.machine() usually contains 'arm' or 'aarch'.
-# If you are on standard Linux desktop, we might need a stricter check, 
-# but for Windows vs Pi, this is usually sufficient.
+# os.uname() is a single syscall; platform.machine() is only the fallback
+# for hosts without it (Windows).
+_MACHINE = os.uname().machine if hasattr(os, "uname") else platform.machine()
+
+# 64-bit Pi OS reports 'aarch64', 32-bit Pi OS 'armv7l' (Pi 2/3/4) or
+# 'armv6l' (Pi Zero / Pi 1).
+_PI_MACHINES = ("aarch64", "armv7l", "armv6l")
+IS_RASPBERRY_PI = sys.platform.startswith("linux") and _MACHINE in _PI_MACHINES
 
 # --- 2. LoRa Hardware Configuration ---
 # Standard SX126x Pin Mapping for Raspberry Pi
@@ -49,24 +56,26 @@ ENV_FACTOR_N = 4.0  # ← CHANGED FOR INDOOR TESTING
 RSSI_AT_1M = -40  # ← Typical indoor value (may need adjustment) 
 
 # --- 5. Load Anchors ---
+_ANCHORS_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config', 'anchors.json'
+)
+
+@functools.lru_cache(maxsize=1)
 def get_anchors():
-    """Reads the anchors.json file and returns the dictionary."""
-    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    json_path = os.path.join(base_dir, 'config', 'anchors.json')
-    
+    """
+    Reads the anchors.json file and returns the dictionary.
+
+    The file is parsed once per process; later calls return the same
+    read-only mapping. Call get_anchors.cache_clear() to force a reload.
+    """
     try:
-        with open(json_path, 'r') as f:
-            return json.load(f)
+        with open(_ANCHORS_PATH, 'r') as f:
+            return types.MappingProxyType(json.load(f))
     except FileNotFoundError:
         print("ERROR: anchors.json not found!")
-        return {}
-
-# Debug Print (Optional, to verify where we are running)
-if __name__ == "__main__":
-    print(f"Running on Raspberry Pi? {IS_RASPBERRY_PI}")
-    print(f"Loaded Anchors: {list(get_anchors().keys())}")
+        return types.MappingProxyType({})
 
-# --- 5. Backend API Configuration ---
+# --- 6. Backend API Configuration ---
 # URL of the backend server (change for production deployment)
 BACKEND_URL = os.environ.get('BACKEND_URL', 'http://192.168.0.32:5000')
 
@@ -79,4 +88,9 @@ GATEWAY_API_KEY = os.environ.get('GATEWAY_API_KEY', 'my-secret-key-12345')
 GPS_REFERENCE = {
     "lat": 11.0168,   # Latitude of MASTER anchor
     "lng": 76.9558    # Longitude of MASTER anchor
-}
\ No newline at end of file
+}
+
+# Debug Print (Optional, to verify where we are running)
+if __name__ == "__main__":
+    print(f"Running on Raspberry Pi? {IS_RASPBERRY_PI}")
+    print(f"Loaded Anchors: {list(get_anchors().keys())}")
@@ -7,16 +7,13 @@ import sys
 import os
 import time
 
-sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# UART device names used by the different Pi models
+SERIAL_PORTS = ('/dev/ttyS0', '/dev/ttyAMA0', '/dev/serial0')
 
 def check_serial_port():
     """Check if serial port exists"""
-    ports = ['/dev/ttyS0', '/dev/ttyAMA0', '/dev/serial0']
-    available = []
-    for port in ports:
-        if os.path.exists(port):
-            available.append(port)
-    return available
+    return [port for port in SERIAL_PORTS if os.path.exists(port)]
 
 def check_gpio():
     """Check if GPIO is accessible"""
@@ -1,11 +1,6 @@
 import argparse
 import sys
 
-# Import our nodes
-from src.nodes.tourist import run_tourist
-from src.nodes.relay import run_relay
-from src.nodes.master import run_master
-
 def main():
     parser = argparse.ArgumentParser(description="LoRa Tourist Safety System")
     parser.add_argument("--mode", required=True, choices=["tourist", "relay", "master"], help="Role of this device")
@@ -13,12 +8,17 @@ def main():
     
     args = parser.parse_args()
     
+    # Import only the node we run: a tourist device should not pay for
+    # numpy and requests, which only the master needs
     try:
         if args.mode == "tourist":
+            from src.nodes.tourist import run_tourist
             run_tourist()
         elif args.mode == "relay":
+            from src.nodes.relay import run_relay
             run_relay(args.id)
         elif args.mode == "master":
+            from src.nodes.master import run_master
             run_master()
     except KeyboardInterrupt:
         print("\n[System] Shutting down...")
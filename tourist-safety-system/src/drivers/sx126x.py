@@ -1,9 +1,50 @@
 # This file is used for LoRa and Raspberry pi4B related issues 
 
-import RPi.GPIO as GPIO
-import serial
+import re
+import select
 import time
 
+# Hardware-only modules. Keep the driver importable on a laptop so the
+# nodes can start in simulation mode; sx126x() itself needs both.
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None
+try:
+    import serial
+except ImportError:
+    serial = None
+
+
+# Frame check: every payload goes on air as "<payload>*XX", XX being the
+# CRC-8 (poly 0x07) of the payload in hex. The "*XX" suffix marks where a
+# frame's payload ends, and frames that fail the check (other LoRa traffic
+# on the channel, corrupted bytes) are dropped on receive.
+def _crc8_of(b):
+    for _ in range(8):
+        b = ((b << 1) ^ 0x07) & 0xFF if b & 0x80 else (b << 1) & 0xFF
+    return b
+
+CRC8 = bytes(_crc8_of(i) for i in range(256))
+_CRC_SUFFIX = tuple(b"*%02X" % i for i in range(256))
+
+
+def crc8(data):
+    """CRC-8 (poly 0x07, init 0) of a bytes payload, via the table."""
+    c = 0
+    for x in data:
+        c = CRC8[c ^ x]
+    return c
+
+
+def check_frame(frame):
+    """Strip and verify the *XX suffix. Returns the payload, or None."""
+    payload = frame[:-3]
+    if frame[-3:] != _CRC_SUFFIX[crc8(payload)]:
+        return None
+    return payload
+
+
 class sx126x:
 
     M0 = 22
@@ -53,6 +94,14 @@ class sx126x:
     SX126X_Power_13dBm = 0x02
     SX126X_Power_10dBm = 0x03
 
+    # largest packet the module hands over: 240 byte payload + RSSI byte
+    MAX_FRAME_SIZE = 241
+
+    # settle time after an M0/M1 mode change (datasheet ~2 ms, plus margin)
+    MODE_SETTLE_TIME = 0.003
+    # (M0, M1) levels last driven, None until the first write
+    _mode = None
+
     lora_air_speed_dic = {
         1200:0x01,
         2400:0x02,
@@ -80,6 +129,8 @@ class sx126x:
     def __init__(self,serial_num,freq,addr,power,rssi,air_speed=2400,\
                  net_id=0,buffer_size = 240,crypt=0,\
                  relay=False,lbt=False,wor=False):
+        if GPIO is None or serial is None:
+            raise RuntimeError("sx126x needs RPi.GPIO and pyserial (Raspberry Pi only)")
         self.rssi = rssi
         self.addr = addr
         self.freq = freq
@@ -90,11 +141,16 @@ class sx126x:
         GPIO.setwarnings(False)
         GPIO.setup(self.M0,GPIO.OUT)
         GPIO.setup(self.M1,GPIO.OUT)
-        GPIO.output(self.M0,GPIO.LOW)
-        GPIO.output(self.M1,GPIO.HIGH)
+        self._set_mode(GPIO.LOW,GPIO.HIGH)
 
         # The hardware UART of Pi3B+,Pi4B is /dev/ttyS0
-        self.ser = serial.Serial(serial_num,9600)
+        # timeout=0: read() returns whatever is buffered without blocking
+        self.ser = serial.Serial(serial_num,9600,timeout=0)
+        # raw descriptor, so callers can block until bytes arrive; the poll
+        # object is registered once instead of rebuilding an fd set per wait
+        self._fd = self.ser.fileno()
+        self._poller = select.poll()
+        self._poller.register(self._fd, select.POLLIN)
         self.ser.flushInput()
         self.set(freq,addr,power,rssi,air_speed,net_id,buffer_size,crypt,relay,lbt,wor)
 
@@ -104,9 +160,7 @@ class sx126x:
         self.send_to = addr
         self.addr = addr
         # We should pull up the M1 pin when sets the module
-        GPIO.output(self.M0,GPIO.LOW)
-        GPIO.output(self.M1,GPIO.HIGH)
-        time.sleep(0.1)
+        self._set_mode(GPIO.LOW,GPIO.HIGH)
 
         low_addr = addr & 0xff
         high_addr = addr >> 8 & 0xff
@@ -136,6 +190,13 @@ class sx126x:
             # disable print rssi value
             rssi_temp = 0x00        
 
+        if lbt:
+            # listen before talk: the module holds a transmission back
+            # while it hears the channel busy (REG3 bit 4)
+            lbt_temp = 0x10
+        else:
+            lbt_temp = 0x00
+
         # get crypt
         l_crypt = crypt & 0xff
         h_crypt = crypt >> 8 & 0xff
@@ -154,7 +215,7 @@ class sx126x:
             # it will output a packet rssi value following received message
             # when enable eighth bit with 06H register(rssi_temp = 0x80)
             #
-            self.cfg_reg[9] = 0x43 + rssi_temp
+            self.cfg_reg[9] = 0x43 + rssi_temp + lbt_temp
             self.cfg_reg[10] = h_crypt
             self.cfg_reg[11] = l_crypt
         else:
@@ -171,7 +232,7 @@ class sx126x:
             # it will output a packet rssi value following received message
             # when enable eighth bit with 06H register(rssi_temp = 0x80)
             #
-            self.cfg_reg[9] = 0x03 + rssi_temp
+            self.cfg_reg[9] = 0x03 + rssi_temp + lbt_temp
             self.cfg_reg[10] = h_crypt
             self.cfg_reg[11] = l_crypt
         self.ser.flushInput()
@@ -208,14 +269,23 @@ class sx126x:
                     # time.sleep(2)
                     # print('\x1b[1A',end='\r')
 
-        GPIO.output(self.M0,GPIO.LOW)
-        GPIO.output(self.M1,GPIO.LOW)
-        time.sleep(0.1)
+        self._set_mode(GPIO.LOW,GPIO.LOW)
+
+    def _set_mode(self, m0, m1):
+        """
+        Drive the M0/M1 mode pins. Writes and settle delay are skipped
+        when the module is already in the requested mode.
+        """
+        if self._mode == (m0, m1):
+            return
+        GPIO.output(self.M0,m0)
+        GPIO.output(self.M1,m1)
+        self._mode = (m0, m1)
+        time.sleep(self.MODE_SETTLE_TIME)
 
     def get_settings(self):
         # the pin M1 of lora HAT must be high when enter setting mode and get parameters
-        GPIO.output(self.M1,GPIO.HIGH)
-        time.sleep(0.1)
+        self._set_mode(GPIO.LOW,GPIO.HIGH)
         
         # send command to get setting parameters
         self.ser.write(bytes([0xC1,0x00,0x09]))
@@ -234,7 +304,7 @@ class sx126x:
             print("Node address is {0}.",addr_temp)
             print("Air speed is {0} bps"+ self.lora_air_speed_dic.get(None,air_speed_temp))
             print("Power is {0} dBm" + self.lora_power_dic.get(None,power_temp))
-            GPIO.output(self.M1,GPIO.LOW)
+            self._set_mode(GPIO.LOW,GPIO.LOW)
 
 #
 # the data format like as following
@@ -243,12 +313,11 @@ class sx126x:
     def send(self, data):
         """
         Send data via LoRa in FIXED transmission mode.
-        Format: [ADDR_H, ADDR_L, CHANNEL, PAYLOAD...]
+        Format: [ADDR_H, ADDR_L, CHANNEL, PAYLOAD..., "*XX" CRC-8]
         Use 0xFFFF for broadcast to all nodes.
         """
-        GPIO.output(self.M1, GPIO.LOW)
-        GPIO.output(self.M0, GPIO.LOW)
-        time.sleep(0.1)
+        # Normal mode; free when the previous call already left us there
+        self._set_mode(GPIO.LOW, GPIO.LOW)
 
         if isinstance(data, str):
             data = data.encode('utf-8')
@@ -256,46 +325,109 @@ class sx126x:
         # Fixed mode requires address header for transmission
         # 0xFF, 0xFF = Broadcast address (all nodes receive)
         # self.offset_freq = Channel offset
-        packet = bytes([0xFF, 0xFF, self.offset_freq]) + data
+        packet = bytes([0xFF, 0xFF, self.offset_freq]) + data + _CRC_SUFFIX[crc8(data)]
         
         self.ser.write(packet)
         time.sleep(0.1)
 
 
+    def wait_rx(self, timeout):
+        """
+        Block until the UART has bytes to read or timeout (seconds) expires.
+        Returns True if data is waiting.
+        """
+        return bool(self._poller.poll(timeout * 1000))
+
 # Receive method for transparent transmission mode
     def receive(self):
         """
         Receive data from LoRa module.
         Data format: [PAYLOAD...] + [RSSI_BYTE]
         """
-        if self.ser.inWaiting() > 0:
-            time.sleep(0.1)  # Wait for full packet
-            r_buff = self.ser.read(self.ser.inWaiting())
-            
-            # Need at least 2 bytes (1 char + RSSI)
-            if len(r_buff) < 2:
+        msg_data, rssi_val = self.receive_raw()
+        # Our protocol is plain ASCII; anything else is noise from the air
+        if msg_data is None or not msg_data.isascii():
+            return None, None
+        return msg_data.decode('ascii'), rssi_val
+
+    def receive_raw(self):
+        """
+        Same as receive(), but returns the payload as undecoded bytes.
+        Of frames that arrived back to back only the first is returned;
+        receive_batch() returns them all.
+        """
+        r_buff = self.ser.read(self.MAX_FRAME_SIZE)
+        if r_buff:
+            # Keep reading until the UART goes quiet for 10 ms (one byte
+            # takes ~1 ms at 9600 baud), i.e. the full packet is in
+            while len(r_buff) < self.MAX_FRAME_SIZE and self.wait_rx(0.01):
+                r_buff += self.ser.read(self.MAX_FRAME_SIZE - len(r_buff))
+
+            frames, _ = self._split_frames(r_buff)
+            if not frames:
                 return None, None
-            
-            # RSSI is the LAST byte
-            # Formula: -(256 - value) to convert to dBm
-            raw_rssi = r_buff[-1]
-            rssi_val = -(256 - raw_rssi)
-            
-            # MESSAGE is everything EXCEPT the last byte (RSSI)
-            try:
-                msg_data = r_buff[:-1]
-                msg = msg_data.decode('utf-8', errors='ignore')
-            except Exception:
-                msg = str(r_buff[:-1])
-            
-            return msg, rssi_val
+            return frames[0]
         else:
             return None, None
 
+    # End of one frame in a drained buffer: the "*XX" check, then the RSSI
+    # byte (any value; below -128 dBm it is ASCII like the payload)
+    _FRAME_END_RE = re.compile(rb"\*[0-9A-F]{2}(.)", re.DOTALL)
+    # Longest payload that fits ahead of the check and the RSSI byte
+    _MAX_PAYLOAD = MAX_FRAME_SIZE - 4
+    # Everything up to the last non-ASCII byte, which no payload contains
+    _UP_TO_HIGH_RE = re.compile(rb".*[\x80-\xff]", re.DOTALL)
+    _rx_tail = b""
+
+    def receive_batch(self, max_frames=16):
+        """
+        Drain every frame the UART has buffered, reading at most
+        max_frames * MAX_FRAME_SIZE bytes.
+
+        Needs RSSI output enabled: each frame then ends in "*XX" plus its
+        RSSI byte, so frames that queued up back to back can be split.
+        Returns a list of (payload bytes, rssi) tuples, oldest first.
+        """
+        limit = max_frames * self.MAX_FRAME_SIZE
+        r_buff = self._rx_tail + self.ser.read(limit)
+        if len(r_buff) > len(self._rx_tail):
+            # Same 10 ms idle gap as receive_raw() marks the end of a burst
+            while len(r_buff) < limit and self.wait_rx(0.01):
+                r_buff += self.ser.read(limit - len(r_buff))
+
+        frames, end = self._split_frames(r_buff)
+        # A frame cut off by the size limit is finished on the next call
+        # (beyond one frame's length the tail can only be noise). If the
+        # UART went idle instead, an unfinished tail is not a frame of ours.
+        self._rx_tail = r_buff[end:][-self.MAX_FRAME_SIZE:] if len(r_buff) >= limit else b""
+        return frames
+
+    def _split_frames(self, r_buff):
+        """
+        Split a buffer into frames after every "*XX" check suffix. The byte
+        after the suffix is the frame's RSSI (dBm = value - 256). A frame
+        that fails its check is dropped on its own; the next one still
+        starts right after it.
+        Returns ([(payload bytes, rssi), ...], end of the last frame).
+        """
+        frames = []
+        end = 0
+        for m in self._FRAME_END_RE.finditer(r_buff):
+            # Anything further back than one payload length is noise
+            start = max(end, m.start() - self._MAX_PAYLOAD)
+            end = m.end()
+            frame = r_buff[start:m.start() + 3]
+            payload = check_frame(frame)
+            if payload is None and not frame.isascii():
+                # Stray bytes ahead of the frame (noise, or what is left of
+                # a frame whose own check was corrupted): retry after them
+                payload = check_frame(frame[self._UP_TO_HIGH_RE.match(frame).end():])
+            if payload is not None:
+                frames.append((payload, m.group(1)[0] - 256))
+        return frames, end
+
     def get_channel_rssi(self):
-        GPIO.output(self.M1,GPIO.LOW)
-        GPIO.output(self.M0,GPIO.LOW)
-        time.sleep(0.1)
+        self._set_mode(GPIO.LOW,GPIO.LOW)
         self.ser.flushInput()
         self.ser.write(bytes([0xC0,0xC1,0xC2,0xC3,0x00,0x02]))
         time.sleep(0.5)
@@ -3,15 +3,37 @@ LoRa Master Node (Anchor 1 / Gateway)
 Collects RSSI readings, performs trilateration, and sends positions to backend.
 """
 
-import time
+import array
+import logging
+import math
 import sys
+import time
 import os
 
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 from src.drivers.sx126x import sx126x
-from src.utils.math_helper import MathEngine
+from src.utils.math_helper import FixedAnchorTrilaterator
 from src.utils.backend_client import BackendClient
+from src.utils.logger import LOG_DIR
+from src.utils.terminal import clear_screen
 from config.settings import get_anchors, SERIAL_PORT, LORA_SETTINGS, IS_RASPBERRY_PI
+from logging.handlers import RotatingFileHandler
+
+# Pi-only; imported once here rather than on every use
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None
+
+log = logging.getLogger("master")
+
+# Anchors in reading-slot order, and the slot for each anchor; a cycle is
+# complete once every bit of the seen-mask is set
+_ORDER = ("MASTER", "ANCHOR_2", "ANCHOR_3")
+_IDX = {name: idx for idx, name in enumerate(_ORDER)}
+_FULL_MASK = (1 << len(_IDX)) - 1
+_POPCOUNT = tuple(bin(m).count("1") for m in range(_FULL_MASK + 1))
+# Same slots keyed by the raw id bytes of a REPORT frame
+_IDX_BYTES = {name.encode('ascii'): idx for name, idx in _IDX.items()}
 
 # ANSI Color Codes for terminal output
 class Colors:
@@ -26,45 +48,156 @@ class Colors:
     DIM = '\033[2m'
     RESET = '\033[0m'
 
-def clear_screen():
-    os.system('clear' if os.name != 'nt' else 'cls')
+# The banner never changes, so it is built once and written in one go
+_HEADER = (
+    f"\n{Colors.CYAN}{Colors.BOLD}\n"
+    "╔══════════════════════════════════════════════════════════╗\n"
+    "║          🛰️  LoRa Tourist Positioning System  🛰️          ║\n"
+    "║                    MASTER NODE ACTIVE                     ║\n"
+    "╚══════════════════════════════════════════════════════════╝\n"
+    f"{Colors.RESET}\n"
+)
 
 def print_header():
-    print(f"\n{Colors.CYAN}{Colors.BOLD}")
-    print("╔══════════════════════════════════════════════════════════╗")
-    print("║          🛰️  LoRa Tourist Positioning System  🛰️          ║")
-    print("║                    MASTER NODE ACTIVE                     ║")
-    print("╚══════════════════════════════════════════════════════════╝")
-    print(f"{Colors.RESET}")
-
-def print_status(anchors_received, total=3):
-    bar = "█" * anchors_received + "░" * (total - anchors_received)
-    color = Colors.GREEN if anchors_received == total else Colors.YELLOW
-    print(f"\r{Colors.DIM}Signal Collection: {color}[{bar}] {anchors_received}/{total}{Colors.RESET}", end='', flush=True)
-
-def print_location(x, y, distances, device_id=None, is_sos=False):
-    print(f"\n\n{Colors.GREEN}{Colors.BOLD}")
-    print("┌──────────────────────────────────────────────────────────┐")
+    sys.stdout.write(_HEADER)
+    sys.stdout.flush()
+
+# Every status line there can be, indexed by the number of anchors heard
+_STATUS_LINES = tuple(
+    f"\r{Colors.DIM}Signal Collection: "
+    f"{Colors.GREEN if n == len(_IDX) else Colors.YELLOW}"
+    f"[{'█' * n}{'░' * (len(_IDX) - n)}] {n}/{len(_IDX)}{Colors.RESET}"
+    for n in range(len(_IDX) + 1)
+)
+# Minimum time between status redraws (seconds)
+STATUS_REDRAW_INTERVAL = 0.1
+
+# Drop a half-collected cycle this long after the tourist's ping (seconds)
+CYCLE_TIMEOUT = 15
+# Heartbeat period towards the backend (seconds)
+HEARTBEAT_INTERVAL = 60
+
+# Positions are smoothed per device with an exponential moving average
+# (weight of the newest fix), and only sent to the backend once the
+# smoothed position has moved at least MIN_MOVE_M meters. SOS always sends.
+EMA_ALPHA = 0.3
+MIN_MOVE_M = 1.0
+# A stationary tourist is still re-sent this often (seconds): the backend
+# only refreshes last_seen on location updates and marks a tourist offline
+# after 5 minutes without one
+MAX_SEND_AGE = 60
+# Tracks of devices not heard from for this long are forgotten (seconds)
+TRACK_IDLE_TIMEOUT = 600
+
+def print_status(anchors_received):
+    sys.stdout.write(_STATUS_LINES[anchors_received])
+    sys.stdout.flush()
+
+def print_location(x, y, distances, device_id=None, is_sos=False, raw=None):
+    """
+    distances: one value per anchor, in _ORDER order. raw: this fix's own
+    (x, y) when x, y are the smoothed position, shown next to it so it
+    can be checked against the distances.
+    """
+    # Collect the whole box and write it at once (one write, one flush)
+    buf = [f"\n\n{Colors.GREEN}{Colors.BOLD}",
+           "┌──────────────────────────────────────────────────────────┐"]
     if is_sos:
-        print(f"│  🚨 SOS ALERT - {device_id or 'UNKNOWN':<40} │")
+        buf.append(f"│  🚨 SOS ALERT - {device_id or 'UNKNOWN':<40} │")
     else:
-        print(f"│  📍 TOURIST LOCATED - {device_id or 'UNKNOWN':<34} │")
-    print("├──────────────────────────────────────────────────────────┤")
-    print(f"│     X = {x:>8.2f} meters                                 │")
-    print(f"│     Y = {y:>8.2f} meters                                 │")
-    print("├──────────────────────────────────────────────────────────┤")
-    print(f"│  {Colors.DIM}Distances:{Colors.GREEN}{Colors.BOLD}                                              │")
-    for anchor, dist in distances.items():
+        buf.append(f"│  📍 TOURIST LOCATED - {device_id or 'UNKNOWN':<34} │")
+    buf.append("├──────────────────────────────────────────────────────────┤")
+    if raw is None:
+        buf.append(f"│     X = {x:>8.2f} meters                                 │")
+        buf.append(f"│     Y = {y:>8.2f} meters                                 │")
+    else:
+        line = f"│     X = {x:>8.2f} m smoothed   (this fix {raw[0]:>8.2f} m)"
+        buf.append(f"{line:<59}│")
+        line = f"│     Y = {y:>8.2f} m smoothed   (this fix {raw[1]:>8.2f} m)"
+        buf.append(f"{line:<59}│")
+    buf.append("├──────────────────────────────────────────────────────────┤")
+    buf.append(f"│  {Colors.DIM}Distances:{Colors.GREEN}{Colors.BOLD}                                              │")
+    for anchor, dist in zip(_ORDER, distances):
         line = f"│    • {anchor}: {dist:.2f}m"
-        print(f"{line:<60}│")
-    print("└──────────────────────────────────────────────────────────┘")
-    print(f"{Colors.RESET}")
+        buf.append(f"{line:<60}│")
+    buf.append("└──────────────────────────────────────────────────────────┘")
+    buf.append(f"{Colors.RESET}\n")
+    sys.stdout.write("\n".join(buf))
+    sys.stdout.flush()
 
 def print_waiting():
     print(f"\n{Colors.DIM}⏳ Waiting for signals...{Colors.RESET}", end='\r')
 
+def setup_logging():
+    """Send log records to a size-capped file instead of the terminal."""
+    os.makedirs(LOG_DIR, exist_ok=True)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+        handlers=[RotatingFileHandler(os.path.join(LOG_DIR, "master.log"),
+                                      maxBytes=1 << 20, backupCount=3)]
+    )
+
+def publish_fix(backend, tracks, result, distances, readings, device_id, is_sos, now):
+    """
+    Smooth a completed fix, show it and queue it for the backend.
+
+    Args:
+        backend (BackendClient): Client the location is queued on
+        tracks (dict): device_id -> [ema_x, ema_y, sent_x, sent_y, sent_at,
+            seen_at], updated in place
+        result (tuple): (x, y) from trilateration, in meters
+        distances (list): Distance to each anchor, in _ORDER order
+        readings (sequence): RSSI per anchor (dBm), in _ORDER order
+        device_id (str): Tourist device ID, or None if unknown
+        is_sos (bool): True if the fix came from an SOS frame
+        now (float): Monotonic time of the fix
+    """
+    x, y = result
+    track = None
+    raw = None
+    if device_id:
+        track = tracks.get(device_id)
+        if track is None:
+            track = tracks[device_id] = [x, y, None, None, None, now]
+        else:
+            track[0] += EMA_ALPHA * (x - track[0])
+            track[1] += EMA_ALPHA * (y - track[1])
+            track[5] = now
+            raw = result
+            x, y = round(track[0], 2), round(track[1], 2)
+
+    print_location(x, y, distances, device_id, is_sos, raw)
+    log.info("fix device=%s x=%.2f y=%.2f raw=%s sos=%s", device_id, x, y, raw, is_sos)
+
+    # Send to backend
+    if track:
+        # A stationary tourist's fixes only differ by RSSI noise; one is
+        # still sent every MAX_SEND_AGE to keep the tourist online
+        if (not is_sos and track[2] is not None
+                and now - track[4] < MAX_SEND_AGE
+                and math.hypot(x - track[2], y - track[3]) < MIN_MOVE_M):
+            print(f"{Colors.DIM}  · Moved < {MIN_MOVE_M:g} m, not sent{Colors.RESET}")
+            return
+        track[2], track[3], track[4] = x, y, now
+        # Integer mean, rounded to nearest (readings are whole dBm)
+        n = len(readings)
+        rssi_avg = (sum(readings) + n // 2) // n
+        success = backend.send_location(
+            device_id=device_id,
+            x=x,
+            y=y,
+            rssi_avg=rssi_avg,
+            sos_flag=is_sos
+        )
+        if success:
+            print(f"{Colors.GREEN}  ✓ Queued for backend{Colors.RESET}")
+        else:
+            print(f"{Colors.YELLOW}  ⚠ Backend queue full, dropped oldest update{Colors.RESET}")
+
 
 def run_master():
+    setup_logging()
     clear_screen()
     print_header()
     
@@ -90,11 +223,20 @@ def run_master():
         return
     
     # Validate required anchors
-    required_anchors = ["MASTER", "ANCHOR_2", "ANCHOR_3"]
-    missing = [a for a in required_anchors if a not in anchors]
+    anchor_cfg = [anchors.get(a) for a in _ORDER]
+    missing = [a for a, cfg in zip(_ORDER, anchor_cfg) if cfg is None]
     if missing:
         print(f"{Colors.RED}✗ Missing anchor config: {missing}{Colors.RESET}")
         return
+
+    # Anchors are fixed for the run: specialise trilateration to this
+    # layout once (this also rejects collinear anchors up front)
+    try:
+        trilaterator = FixedAnchorTrilaterator(
+            [(cfg["x"], cfg["y"]) for cfg in anchor_cfg])
+    except ValueError:
+        print(f"{Colors.RED}✗ Anchors are collinear! Cannot trilaterate{Colors.RESET}")
+        return
     
     # Initialize backend client
     backend = BackendClient()
@@ -102,141 +244,155 @@ def run_master():
     
     if backend.check_connection():
         print(f"{Colors.GREEN}✓ Backend connected{Colors.RESET}")
-        backend.send_heartbeat(anchor_id="MASTER", stats={"startup": True})
+        backend.queue_heartbeat(anchor_id="MASTER", stats={"startup": True})
     else:
         print(f"{Colors.YELLOW}⚠ Backend unreachable - will retry on each update{Colors.RESET}")
     
     print(f"\n{Colors.GREEN}{Colors.BOLD}✓ Ready! Awaiting tourist signals...{Colors.RESET}\n")
     
     # State tracking
-    current_readings = {}
-    last_ping_time = time.time()
-    last_heartbeat_time = time.time()
+    readings = array.array('i', [0] * len(_IDX))
+    seen_mask = 0
+    shown_mask = 0
+    now = time.monotonic()
+    # Timers are absolute deadlines on the monotonic clock
+    ping_deadline = now + CYCLE_TIMEOUT
+    next_heartbeat = now + HEARTBEAT_INTERVAL
+    next_status_draw = now
     current_device_id = None
     is_sos = False
+    # Smoothed / last-sent position per tourist device (see publish_fix)
+    tracks = {}
     
     # Counters
     total_positions = 0
-    successful_sends = 0
+
+    # Frames are "<KIND>:<fields>"; each handler gets the bytes after KIND:
+    #   tourist: "PING:<device>" / "SOS:<device>"
+    #   relay:   "REPORT:<anchor>:<rssi>"
+
+    # Direct PING/SOS from tourist
+    def on_tourist(rest, rssi, sos):
+        nonlocal seen_mask, ping_deadline, current_device_id, is_sos
+        device, _, _ = rest.partition(b":")
+        if not device:
+            return
+        readings[0] = rssi
+        seen_mask |= 1
+        ping_deadline = now + CYCLE_TIMEOUT
+        current_device_id = device.decode('ascii', 'ignore').strip().upper()
+        is_sos = sos
+
+    def on_ping(rest, rssi):
+        on_tourist(rest, rssi, False)
+
+    def on_sos(rest, rssi):
+        on_tourist(rest, rssi, True)
+
+    # Report from relay
+    def on_report(rest, rssi):
+        nonlocal seen_mask
+        sender, _, val = rest.partition(b":")
+        idx = _IDX_BYTES.get(sender.strip().upper())
+        if idx is None:
+            return
+        # int() parses the ASCII digits straight from bytes; values that
+        # don't fit a reading slot are as bad as non-numbers
+        try:
+            readings[idx] = int(val)
+        except (ValueError, OverflowError):
+            return
+        seen_mask |= 1 << idx
+
+    handlers = {b"PING": on_ping, b"SOS": on_sos, b"REPORT": on_report}
     
+    # Frames drained from the UART but not yet handled, oldest first
+    batch = iter(())
+
     try:
         while True:
-            # Receive data
-            msg, rssi = None, None
-            if lora:
-                msg, rssi = lora.receive()
+            # Handle one frame per iteration; only block on the serial port
+            # (instead of polling) once the last drained batch is used up
+            frame = next(batch, None)
+            if frame is None:
+                if lora:
+                    if lora.wait_rx(0.2):
+                        batch = iter(lora.receive_batch())
+                        frame = next(batch, None)
+                else:
+                    time.sleep(0.2)
+            # One clock read per iteration, taken right after the wait
+            now = time.monotonic()
             
-            if msg:
-                # Direct PING/SOS from tourist
-                if "PING" in msg or "SOS" in msg:
-                    current_readings["MASTER"] = rssi
-                    last_ping_time = time.time()
-                    
-                    # Extract device ID
-                    try:
-                        parts = msg.split(":")
-                        if len(parts) >= 2:
-                            current_device_id = parts[1].strip().upper()
-                        is_sos = "SOS" in msg
-                    except:
-                        current_device_id = "UNKNOWN"
-                
-                # Report from relay
-                elif "REPORT" in msg:
-                    try:
-                        parts = msg.split(":")
-                        sender_id = parts[1].strip().upper()
-                        reported_rssi = int(parts[2])
-                        current_readings[sender_id] = reported_rssi
-                    except:
-                        pass
-
-            # Update status bar
-            if len(current_readings) > 0:
-                print_status(len(current_readings))
+            if frame:
+                msg, rssi = frame
+                kind, _, rest = msg.strip().partition(b":")
+                handler = handlers.get(kind)
+                if handler:
+                    handler(rest, rssi)
+
+            # Update status bar (only when a new reading arrived, at most
+            # every STATUS_REDRAW_INTERVAL; a completed cycle always shows)
+            if seen_mask != shown_mask and (
+                    seen_mask == _FULL_MASK
+                    or now >= next_status_draw):
+                if seen_mask:
+                    print_status(_POPCOUNT[seen_mask])
+                log.debug("readings=%s mask=%#x", readings, seen_mask)
+                shown_mask = seen_mask
+                next_status_draw = now + STATUS_REDRAW_INTERVAL
 
             # Triangulate when we have all 3 readings
-            if len(current_readings) >= 3:
+            if seen_mask == _FULL_MASK:
                 total_positions += 1
                 
-                tri_input = []
-                distances = {}
-                rssi_values = []
-                
-                # Build trilateration input
-                for anchor_id in ["MASTER", "ANCHOR_2", "ANCHOR_3"]:
-                    if anchor_id in current_readings:
-                        rssi_val = current_readings[anchor_id]
-                        dist = MathEngine.rssi_to_distance(rssi_val)
-                        distances[anchor_id] = dist
-                        rssi_values.append(rssi_val)
-                        tri_input.append({
-                            'x': anchors[anchor_id]["x"], 
-                            'y': anchors[anchor_id]["y"], 
-                            'r': dist
-                        })
-
                 # Calculate position
-                if len(tri_input) >= 3:
-                    result = MathEngine.trilaterate(tri_input)
-                    
-                    if result:
-                        x, y = result[0], result[1]
-                        print_location(x, y, distances, current_device_id, is_sos)
-                        
-                        # Send to backend
-                        if current_device_id:
-                            rssi_avg = int(sum(rssi_values) / len(rssi_values))
-                            success = backend.send_location(
-                                device_id=current_device_id,
-                                x=x,
-                                y=y,
-                                rssi_avg=rssi_avg,
-                                sos_flag=is_sos
-                            )
-                            if success:
-                                successful_sends += 1
-                                print(f"{Colors.GREEN}  ✓ Sent to backend{Colors.RESET}")
-                            else:
-                                print(f"{Colors.YELLOW}  ⚠ Backend send failed{Colors.RESET}")
-                        
-                        print(f"{Colors.DIM}  Stats: Positions={total_positions}, Sent={successful_sends}{Colors.RESET}")
-                    else:
-                        print(f"\n{Colors.RED}❌ Trilateration failed{Colors.RESET}")
+                # Distances stay in anchor-slot order end to end (no per-fix dict)
+                result, distances = trilaterator.locate(readings)
                 
+                if result:
+                    publish_fix(backend, tracks, result, distances, readings,
+                                current_device_id, is_sos, now)
+                    print(f"{Colors.DIM}  Stats: Positions={total_positions}, Sent={backend.sent_count}{Colors.RESET}")
+                else:
+                    print(f"\n{Colors.RED}❌ Trilateration failed{Colors.RESET}")
+            
                 # Reset for next cycle
-                current_readings = {}
+                seen_mask = 0
                 current_device_id = None
                 is_sos = False
                 print_waiting()
 
             # Timeout handling
-            if time.time() - last_ping_time > 15 and len(current_readings) > 0:
+            if now >= ping_deadline and seen_mask:
                 print(f"\n{Colors.YELLOW}⚠ Timeout - clearing incomplete data{Colors.RESET}")
-                current_readings = {}
+                log.warning("cycle timeout, dropping readings mask=%#x", seen_mask)
+                seen_mask = 0
                 current_device_id = None
                 is_sos = False
-                last_ping_time = time.time()
+                ping_deadline = now + CYCLE_TIMEOUT
             
-            # Periodic heartbeat (every 60 seconds)
-            if time.time() - last_heartbeat_time > 60:
-                backend.send_heartbeat(
+            # Periodic heartbeat (every HEARTBEAT_INTERVAL seconds)
+            if now >= next_heartbeat:
+                backend.queue_heartbeat(
                     anchor_id="MASTER",
                     stats={
                         "total_positions": total_positions,
-                        "successful_sends": successful_sends
+                        "successful_sends": backend.sent_count
                     }
                 )
-                last_heartbeat_time = time.time()
-                
-            time.sleep(0.01)
+                next_heartbeat = now + HEARTBEAT_INTERVAL
+                # Forget devices that have gone quiet (left the area)
+                for device in [d for d, t in tracks.items()
+                               if now - t[5] > TRACK_IDLE_TIMEOUT]:
+                    del tracks[device]
             
     except KeyboardInterrupt:
         print(f"\n\n{Colors.YELLOW}Shutting down...{Colors.RESET}")
     finally:
-        if IS_RASPBERRY_PI:
+        backend.close()
+        if IS_RASPBERRY_PI and GPIO:
             try:
-                import RPi.GPIO as GPIO
                 GPIO.cleanup()
             except:
                 pass
@@ -3,12 +3,23 @@ LoRa Relay Node (Anchor 2 / Anchor 3)
 Receives tourist pings and reports RSSI to the master node.
 """
 
-import time
-import sys
+import bisect
+import logging
+import logging.handlers
 import os
+import queue
+import random
+import sys
+import threading
+import time
+
+import numpy as np
 
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
+from src.drivers.sx126x import sx126x
 from config.settings import IS_RASPBERRY_PI
+from src.utils.math_helper import MathEngine
+
+log = logging.getLogger("relay")
 
 # ============ CONFIGURATION ============
 # This relay's ID (e.g., "ANCHOR_2" or "ANCHOR_3")
@@ -17,6 +28,120 @@ DEFAULT_RELAY_ID = "ANCHOR_2"
 # Report interval after receiving a ping
 REPORT_DELAY = 0.5  # seconds
 
+# Relays answer the same ping, so each gets its own transmit slot:
+# ANCHOR_n reports REPORT_DELAY + (n - 2) * SLOT_WIDTH after the ping
+# arrived. Slots are fixed rather than jittered, so they never overlap.
+SLOT_WIDTH = 0.5  # seconds
+
+# Frames are "<KIND>:<fields>"; the relay only answers tourist frames.
+# Matched on the raw bytes, so a frame is never decoded just to dispatch it.
+_TOURIST_PREFIXES = (b"PING:", b"SOS:")
+
+# Rule printed after every report, built once
+_SEPARATOR = "-" * 40
+
+# The reported RSSI is smoothed over the last RSSI_SAMPLES pings from the
+# same tourist (a sliding window), which knocks out single-packet fades.
+# RSSI_FILTER picks the smoother:
+#   "median":   plain window median, as the relay has always reported
+#   "gaussian": mean weighted by exp(-age^2 / (2 * sigma^2)), newest = age 0;
+#               shifts the reported RSSI, so re-check RSSI_AT_1M and
+#               ENV_FACTOR_N before switching to it
+RSSI_SAMPLES = 5
+RSSI_FILTER = "median"
+RSSI_GAUSS_SIGMA = 2.0  # in samples
+
+# Optional real-time scheduling for the receive loop (Linux only). Set
+# RELAY_RX_CPU to a core reserved for it (e.g. 3 with isolcpus=3 in
+# cmdline.txt) to pin the loop there under SCHED_FIFO. Needs root or
+# CAP_SYS_NICE; unset, the relay runs with normal scheduling.
+RX_CPU = os.environ.get('RELAY_RX_CPU')
+RX_PRIORITY = 50
+
+
+class RssiWindow:
+    """Sliding window over the most recent RSSI readings of one device."""
+
+    def __init__(self, size=RSSI_SAMPLES, sigma=RSSI_GAUSS_SIGMA):
+        # Preallocated ring buffer; only the first `filled` slots are valid
+        self.buf = np.empty(size, dtype=np.int16)
+        self.idx = 0
+        self.filled = 0
+        # The same samples kept sorted, so the median is an index lookup
+        self._sorted = []
+        # Gaussian weight for each sample age, computed once per window
+        ages = np.arange(size)
+        self._slots = ages
+        self._age_weights = np.exp(-ages ** 2 / (2.0 * sigma ** 2))
+
+    def add(self, rssi):
+        """Store a reading and return the window median (whole dBm)."""
+        self._push(rssi)
+        s = self._sorted
+        mid = len(s) // 2
+        if len(s) % 2:
+            return s[mid]
+        return int(round((s[mid - 1] + s[mid]) / 2))
+
+    def add_gaussian(self, rssi):
+        """Store a reading and return the Gaussian-weighted mean (whole dBm)."""
+        self._push(rssi)
+        n = self.filled
+        # Age of the sample in each slot; the newest sits just before idx
+        ages = (self.idx - 1 - self._slots[:n]) % len(self.buf)
+        w = self._age_weights[ages]
+        return int(round(np.dot(self.buf[:n], w) / w.sum()))
+
+    def _push(self, rssi):
+        size = len(self.buf)
+        rssi = int(rssi)
+        if self.filled == size:
+            # Window full: the slot being overwritten leaves the window
+            s = self._sorted
+            del s[bisect.bisect_left(s, int(self.buf[self.idx]))]
+        bisect.insort(self._sorted, rssi)
+        self.buf[self.idx] = rssi
+        self.idx = (self.idx + 1) % size
+        if self.filled < size:
+            self.filled += 1
+
+
+def slot_offset(relay_id):
+    """Seconds after a ping at which relay_id sends its report."""
+    _, _, n = relay_id.rpartition("_")
+    slot = int(n) - 2 if n.isdigit() else 0
+    return REPORT_DELAY + max(slot, 0) * SLOT_WIDTH
+
+
+def set_rx_realtime(cpu, priority=RX_PRIORITY):
+    """
+    Pin the calling thread to `cpu` and give it SCHED_FIFO priority.
+    Threads started afterwards inherit this, so call it once the TX and
+    log threads are running. Returns True on success.
+    """
+    try:
+        os.sched_setaffinity(0, {int(cpu)})
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        return True
+    except (AttributeError, ValueError, OSError):
+        # Not Linux, bad core number or not privileged
+        return False
+
+
+def setup_logging():
+    """
+    Per-packet output goes through logging with a QueueHandler: the
+    receive loop only enqueues a record, and a listener thread writes it
+    to the terminal. Returns the listener; stop() it to flush on exit.
+    """
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(
+        log_queue, logging.StreamHandler(sys.stdout))
+    logging.basicConfig(level=logging.INFO, format="%(message)s",
+                        handlers=[logging.handlers.QueueHandler(log_queue)])
+    listener.start()
+    return listener
+
 
 def run_relay(relay_id=None):
     """
@@ -34,8 +159,6 @@ def run_relay(relay_id=None):
     
     # Initialize LoRa
     if IS_RASPBERRY_PI:
-        from src.drivers.sx126x import sx126x
-        
         # Setup as receiver with RSSI enabled
         node = sx126x(
             serial_num='/dev/ttyS0',
@@ -52,65 +175,147 @@ def run_relay(relay_id=None):
     # Stats
     pings_received = 0
     reports_sent = 0
-    
+
+    # One smoothing window per tourist device
+    windows = {}
+
+    # Per-run constants, resolved once instead of on every ping
+    rx_fmt = f"[{relay_id}] 📥 Received: %s | RSSI: %s dBm"
+    sent_fmt = (f"[{relay_id}] 📤 Report sent: %s (~%.2fm)\n"
+                f"[{relay_id}] Stats: Pings=%d, Reports=%d\n{_SEPARATOR}")
+    report_prefix = f"REPORT:{relay_id}:".encode('ascii')
+    smooth = RssiWindow.add_gaussian if RSSI_FILTER == "gaussian" else RssiWindow.add
+    monotonic = time.monotonic
+
+    # Offset of this relay's slot from the ping, fixed for the run
+    delay = slot_offset(relay_id)
+
+    # Reports go out from a worker thread, so the stagger delay no longer
+    # blinds the receiver. Items are (due time, report, rssi, device, sos);
+    # the radio is half-duplex over one UART, so receive and send share
+    # radio_lock. Setting `stopping` (plus a None item to wake it) ends the
+    # worker during a stagger wait, but never in the middle of a
+    # transmission.
+    #
+    # A new ping restarts the master's cycle for that tourist, so a report
+    # for the same device still waiting for its slot is stale and the newer
+    # one takes its place. Reports for other devices are kept, and one that
+    # came from an SOS frame is never superseded.
+    radio_lock = threading.Lock()
+    outbox = queue.Queue(maxsize=16)
+    stopping = threading.Event()
+
+    def tx_worker():
+        nonlocal reports_sent
+        pending = []  # items waiting for their slot, soonest due first
+        while True:
+            timeout = max(0.0, pending[0][0] - time.monotonic()) if pending else None
+            try:
+                item = outbox.get(timeout=timeout)
+            except queue.Empty:
+                if stopping.is_set():
+                    return
+            else:
+                if item is None:
+                    return
+                device = item[3]
+                for i, queued in enumerate(pending):
+                    if queued[3] == device and not queued[4]:
+                        del pending[i]
+                        log.debug("[%s] superseded report for %s skipped", relay_id,
+                                  device.decode('ascii', 'replace'))
+                        break
+                bisect.insort(pending, item)
+                continue
+            _, report, rssi, _, _ = pending.pop(0)
+            with radio_lock:
+                node.send(report)
+            reports_sent += 1
+            # Distance estimate is a table lookup; shown to help calibrate
+            # RSSI_AT_1M / ENV_FACTOR_N from the relay's console
+            log.info(sent_fmt, report.decode('ascii'), MathEngine.rssi_to_distance(rssi),
+                     pings_received, reports_sent)
+
+    tx_thread = threading.Thread(target=tx_worker, daemon=True)
+    if node:
+        tx_thread.start()
+
     print(f"\n[{relay_id}] Listening for tourist pings...")
     print(f"[{relay_id}] Press Ctrl+C to stop\n")
+
+    listener = setup_logging()
+
+    # Only this (receive) thread; the TX and log threads are already up
+    if node and RX_CPU is not None:
+        if set_rx_realtime(RX_CPU):
+            print(f"[{relay_id}] RX loop on CPU {RX_CPU}, SCHED_FIFO {RX_PRIORITY}")
+        else:
+            print(f"[{relay_id}] ⚠️ Could not set real-time scheduling, continuing without it")
     
     try:
         while True:
-            # Receive message
+            # Receive messages (block on the serial port until a packet
+            # starts arriving instead of polling). Every frame the UART
+            # holds is drained: a ping can land right behind our own send.
+            frames = ()
             if node:
-                message, rssi = node.receive()
+                if node.wait_rx(1.0):
+                    with radio_lock:
+                        frames = node.receive_batch()
+                    # The report slot is counted from here
+                    rx_time = monotonic()
             else:
-                # Simulation - no messages
-                message, rssi = None, None
+                # Simulation - no messages, and no port to block on
+                time.sleep(1.0)
             
-            # Process if we got a message
-            if message:
-                print(f"[{relay_id}] 📥 Received: {message} | RSSI: {rssi} dBm")
+            # Process each message we got
+            for message, rssi in frames:
+                log.info(rx_fmt, message.decode('ascii', 'replace'), rssi)
                 
-                # Only respond to PING or SOS from tourists
-                if "PING" in message or "SOS" in message:
+                # Only respond to PING or SOS from tourists (match the
+                # frame kind, not a substring anywhere in the payload)
+                if message.startswith(_TOURIST_PREFIXES):
                     pings_received += 1
+
+                    _, _, device = message.partition(b":")
+                    window = windows.get(device)
+                    if window is None:
+                        window = windows[device] = RssiWindow()
+                    smoothed = smooth(window, rssi)
                     
-                    # Small delay to avoid collision with other relays
-                    # Each relay should have different delay
-                    delay = REPORT_DELAY
-                    if relay_id == "ANCHOR_3":
-                        delay = REPORT_DELAY * 2  # Anchor 3 waits longer
-                    
-                    time.sleep(delay)
-                    
-                    # Send report to master
+                    # Send report to master in this relay's slot
                     # Format: "REPORT:ANCHOR_ID:RSSI"
-                    report = f"REPORT:{relay_id}:{rssi}"
+                    # One bytes object per report, ready for node.send()
+                    report = report_prefix + b"%d" % smoothed
                     
                     if node:
-                        node.send(report.encode())
-                        reports_sent += 1
-                        print(f"[{relay_id}] 📤 Report sent: {report}")
+                        try:
+                            outbox.put_nowait((rx_time + delay, report, smoothed, device,
+                                               message.startswith(b"SOS:")))
+                        except queue.Full:
+                            log.warning("[%s] ⚠️ Report queue full, dropping: %s", relay_id, report.decode('ascii'))
                     else:
-                        print(f"[{relay_id}] 📤 Would send: {report} (simulation)")
-                    
-                    print(f"[{relay_id}] Stats: Pings={pings_received}, Reports={reports_sent}")
-                    print("-" * 40)
-            
-            # Small delay to prevent CPU overload
-            time.sleep(0.05)
+                        log.info("[%s] 📤 Would send: %s (simulation)", relay_id, report.decode('ascii'))
             
     except KeyboardInterrupt:
+        stopping.set()
+        try:
+            outbox.put_nowait(None)
+        except queue.Full:
+            pass
+        if tx_thread.is_alive():
+            tx_thread.join(timeout=2.0)
+        listener.stop()
         print(f"\n\n[{relay_id}] Shutting down...")
         print(f"[{relay_id}] Final stats: Pings={pings_received}, Reports={reports_sent}")
 
 
-def run_relay_simulation():
+def run_relay_simulation(relay_id=None):
     """
     Simulation mode for testing without hardware.
     Generates fake RSSI readings and reports.
     """
-    import random
-    
-    relay_id = "ANCHOR_2"
+    relay_id = (relay_id or DEFAULT_RELAY_ID).upper()
     print(f"[{relay_id}] Running in simulation mode")
     print(f"[{relay_id}] Generating fake readings every 3 seconds")
     
@@ -134,6 +339,6 @@ if __name__ == "__main__":
     args = parser.parse_args()
     
     if args.simulate:
-        run_relay_simulation()
+        run_relay_simulation(args.id)
     else:
         run_relay(args.id)
\ No newline at end of file
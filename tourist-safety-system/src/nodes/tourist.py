@@ -3,14 +3,41 @@ LoRa Tourist Device (Wearable/Handheld)
 Broadcasts periodic pings and SOS signals.
 """
 
-import time
+import atexit
+import signal
 import sys
+import threading
+import time
 import os
 
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 from src.drivers.sx126x import sx126x
+from src.utils import logger
+from src.utils.terminal import clear_screen
 from config.settings import SERIAL_PORT, LORA_SETTINGS, IS_RASPBERRY_PI
 
+# Pi-only; imported once here rather than on every use
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None
+
+
+def _release_gpio():
+    try:
+        GPIO.cleanup()
+    except Exception:
+        pass
+
+# Release the pins on any normal interpreter exit, not just Ctrl+C, so
+# the next start doesn't find the SOS pin still claimed
+if IS_RASPBERRY_PI and GPIO:
+    atexit.register(_release_gpio)
+
+
+def _exit_on_sigterm():
+    """Turn SIGTERM (systemd stop) into a normal exit so atexit runs."""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
 # ============ CONFIGURATION ============
 # Each tourist device should have a unique ID
 # This ID must be registered in the backend before use
@@ -22,6 +49,12 @@ PING_INTERVAL = 2
 # SOS button GPIO pin (Raspberry Pi)
 SOS_PIN = 17
 
+# Without a terminal (e.g. running as a systemd service, output going to
+# the journal) the per-ping status line is replaced by a log line (console
+# and daily log file) every STATUS_EVERY pings and whenever SOS is switched
+# on or off
+STATUS_EVERY = 30
+
 # ANSI Color Codes
 class Colors:
     CYAN = '\033[96m'
@@ -32,16 +65,71 @@ class Colors:
     BOLD = '\033[1m'
     RESET = '\033[0m'
 
+    @classmethod
+    def disable(cls):
+        """Blank every code, for output that isn't going to a terminal."""
+        for name in ('CYAN', 'GREEN', 'YELLOW', 'RED', 'DIM', 'BOLD', 'RESET'):
+            setattr(cls, name, '')
+
+
+def build_frames(device_id):
+    """
+    Encode the PING and SOS frames for a device. Both are constant for a
+    run, so callers build them once and send the same bytes every time.
+
+    Raises:
+        ValueError: If device_id can't be carried in a frame. Receivers
+            drop non-ASCII frames, ':' separates the frame's fields and
+            '*' starts its check suffix.
+    """
+    if not (device_id and device_id.isascii() and device_id.isprintable()
+            and ':' not in device_id and '*' not in device_id):
+        raise ValueError(f"DEVICE_ID must be printable ASCII without ':' or '*', got {device_id!r}")
+    return f"PING:{device_id}".encode('ascii'), f"SOS:{device_id}".encode('ascii')
+
+
+def frames_or_exit(device_id):
+    """build_frames(), exiting with its message on a bad device id."""
+    try:
+        return build_frames(device_id)
+    except ValueError as e:
+        sys.exit(f"❌ {e}")
+
+
+def wait_for_tick(next_tick):
+    """
+    Sleep until next_tick (a time.monotonic() value) and return the tick
+    after it. Sleeping to a fixed tick rather than a full PING_INTERVAL
+    after each send keeps LoRa airtime from drifting the cadence.
+    """
+    delay = next_tick - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+    elif delay < -PING_INTERVAL:
+        # Fell far behind (e.g. system suspended): resync instead
+        # of firing a burst of catch-up pings
+        next_tick = time.monotonic()
+    return next_tick + PING_INTERVAL
+
 
 def run_tourist():
-    # Clear screen
-    os.system('clear' if os.name != 'nt' else 'cls')
-    
-    print(f"\n{Colors.CYAN}{Colors.BOLD}")
-    print("╔════════════════════════════════════════╗")
-    print("║   🚶  TOURIST TRACKER DEVICE           ║")
-    print("╚════════════════════════════════════════╝")
-    print(f"{Colors.RESET}")
+    _exit_on_sigterm()
+    # Both frames are constant for the run: build and encode them once
+    ping_frame, sos_frame = frames_or_exit(DEVICE_ID)
+    interactive = sys.stdout.isatty()
+    if not interactive:
+        # Escape codes would reach the journal as literal noise
+        Colors.disable()
+
+    if interactive:
+        # Clear screen
+        clear_screen()
+        
+        print(f"\n{Colors.CYAN}{Colors.BOLD}")
+        print("╔════════════════════════════════════════╗")
+        print("║   🚶  TOURIST TRACKER DEVICE           ║")
+        print("╚════════════════════════════════════════╝")
+        print(f"{Colors.RESET}")
     
     print(f"Device ID: {Colors.GREEN}{DEVICE_ID}{Colors.RESET}")
     
@@ -49,71 +137,87 @@ def run_tourist():
     print(f"{Colors.DIM}Frequency: {freq} MHz{Colors.RESET}")
     print(f"{Colors.DIM}Ping Interval: {PING_INTERVAL}s{Colors.RESET}")
     
-    # Initialize LoRa
+    # SOS is latched by the button: one press switches to SOS frames, the
+    # next press back to normal pings. The edge callback runs on RPi.GPIO's
+    # event thread, hence an Event rather than a plain flag.
+    sos_latch = threading.Event()
+
+    def on_sos_button(channel):
+        if sos_latch.is_set():
+            sos_latch.clear()
+        else:
+            sos_latch.set()
+
+    # Initialize LoRa (listen-before-talk on, so a ping waits out another
+    # device's transmission instead of colliding with it)
     if IS_RASPBERRY_PI:
-        import RPi.GPIO as GPIO
-        node = sx126x(serial_num=SERIAL_PORT, freq=freq, addr=100, power=22, rssi=False)
+        node = sx126x(serial_num=SERIAL_PORT, freq=freq, addr=100, power=22, rssi=False, lbt=True)
         print(f"{Colors.GREEN}✓ LoRa initialized{Colors.RESET}")
         
-        # Setup SOS button
+        # Setup SOS button (edge interrupt, so a press between pings is
+        # never missed)
         try:
             GPIO.setmode(GPIO.BCM)
             GPIO.setup(SOS_PIN, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+            GPIO.add_event_detect(SOS_PIN, GPIO.RISING,
+                                  callback=on_sos_button, bouncetime=200)
             print(f"{Colors.GREEN}✓ SOS button on GPIO {SOS_PIN}{Colors.RESET}")
-            sos_button_available = True
         except Exception as e:
             print(f"{Colors.YELLOW}⚠ SOS button not configured: {e}{Colors.RESET}")
-            sos_button_available = False
     else:
         node = None
-        sos_button_available = False
         print(f"{Colors.YELLOW}⚠ Running in simulation mode (not on Pi){Colors.RESET}")
     
     print(f"\n{Colors.GREEN}{Colors.BOLD}✓ Tracker active!{Colors.RESET}\n")
     
     ping_count = 0
-    is_sos = False
+
+    ping_msg, sos_msg = ping_frame.decode('ascii'), sos_frame.decode('ascii')
+    # Status lines too; only the counter changes per ping (a '%' in the
+    # device id is escaped so it survives the formatting)
+    ping_line = f"\r{Colors.GREEN}📡 Ping #%d: {ping_msg.replace('%', '%%')}{Colors.RESET}  "
+    sos_line = f"\r{Colors.RED}🚨 SOS #%d: {sos_msg.replace('%', '%%')}{Colors.RESET}  "
+
+    send = node.send if node else None
+    next_tick = time.monotonic() + PING_INTERVAL
+    was_sos = False
     
     try:
         while True:
-            # Check SOS button
-            if sos_button_available:
-                try:
-                    import RPi.GPIO as GPIO
-                    is_sos = GPIO.input(SOS_PIN) == GPIO.HIGH
-                except:
-                    pass
+            # Check SOS latch (set/cleared by the button callback)
+            is_sos = sos_latch.is_set()
             
             ping_count += 1
             
-            # Build message
+            # Pick message
             if is_sos:
-                message = f"SOS:{DEVICE_ID}"
-                print(f"\r{Colors.RED}🚨 SOS #{ping_count}: {message}{Colors.RESET}  ", end='', flush=True)
+                frame = sos_frame
+                if interactive:
+                    print(sos_line % ping_count, end='', flush=True)
             else:
-                message = f"PING:{DEVICE_ID}"
-                print(f"\r{Colors.GREEN}📡 Ping #{ping_count}: {message}{Colors.RESET}  ", end='', flush=True)
+                frame = ping_frame
+                if interactive:
+                    print(ping_line % ping_count, end='', flush=True)
+            if not interactive and (is_sos != was_sos or ping_count % STATUS_EVERY == 0):
+                logger.log(f"Ping #{ping_count}: {sos_msg if is_sos else ping_msg}",
+                           "WARNING" if is_sos else "INFO", DEVICE_ID)
+                was_sos = is_sos
             
             # Transmit
-            if node:
-                node.send(message.encode())
+            if send:
+                send(frame)
             
-            time.sleep(PING_INTERVAL)
+            next_tick = wait_for_tick(next_tick)
             
     except KeyboardInterrupt:
         print(f"\n\n{Colors.YELLOW}Stopped after {ping_count} pings.{Colors.RESET}")
-    finally:
-        if IS_RASPBERRY_PI:
-            try:
-                import RPi.GPIO as GPIO
-                GPIO.cleanup()
-            except:
-                pass
 
 
 def run_tourist_with_sos_test():
     """Test mode: Simulates SOS trigger after a few pings."""
-    os.system('clear' if os.name != 'nt' else 'cls')
+    _exit_on_sigterm()
+    ping_frame, sos_frame = frames_or_exit(DEVICE_ID)
+    clear_screen()
     
     print(f"\n{Colors.CYAN}{Colors.BOLD}")
     print("╔════════════════════════════════════════╗")
@@ -126,12 +230,14 @@ def run_tourist_with_sos_test():
     freq = LORA_SETTINGS.get("FREQUENCY", 865)
     
     if IS_RASPBERRY_PI:
-        node = sx126x(serial_num=SERIAL_PORT, freq=freq, addr=100, power=22, rssi=False)
+        node = sx126x(serial_num=SERIAL_PORT, freq=freq, addr=100, power=22, rssi=False, lbt=True)
     else:
         node = None
         print(f"{Colors.YELLOW}⚠ Simulation mode{Colors.RESET}")
     
     ping_count = 0
+    ping_msg, sos_msg = ping_frame.decode('ascii'), sos_frame.decode('ascii')
+    next_tick = time.monotonic() + PING_INTERVAL
     
     try:
         while True:
@@ -139,16 +245,16 @@ def run_tourist_with_sos_test():
             is_sos = 5 <= ping_count <= 7
             
             if is_sos:
-                message = f"SOS:{DEVICE_ID}"
-                print(f"{Colors.RED}🚨 [{ping_count}] SOS: {message}{Colors.RESET}")
+                frame = sos_frame
+                print(f"{Colors.RED}🚨 [{ping_count}] SOS: {sos_msg}{Colors.RESET}")
             else:
-                message = f"PING:{DEVICE_ID}"
-                print(f"{Colors.GREEN}📡 [{ping_count}] Ping: {message}{Colors.RESET}")
+                frame = ping_frame
+                print(f"{Colors.GREEN}📡 [{ping_count}] Ping: {ping_msg}{Colors.RESET}")
             
             if node:
-                node.send(message.encode())
+                node.send(frame)
             
-            time.sleep(PING_INTERVAL)
+            next_tick = wait_for_tick(next_tick)
             
     except KeyboardInterrupt:
         print(f"\n{Colors.YELLOW}Stopped{Colors.RESET}")
@@ -3,33 +3,84 @@ Backend API Client for LoRa Tourist Safety System
 Sends trilaterated positions to the Node.js backend
 """
 
+import collections
+import json
+import math
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import sys
-import os
 
-# Add project root to path
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 from config.settings import BACKEND_URL, GATEWAY_API_KEY, GPS_REFERENCE
 
 
+def _json_body(payload):
+    """
+    Serialize a request body once, compactly (requests' json= puts a space
+    after every separator). Content-Type is set on the session.
+    """
+    return json.dumps(payload, separators=(',', ':'), allow_nan=False).encode('ascii')
+
+
 class BackendClient:
     """HTTP client for communicating with the Tourist Safety Backend"""
     
     def __init__(self):
         self.base_url = BACKEND_URL
-        self.headers = {
-            'Content-Type': 'application/json',
-            'X-API-Key': GATEWAY_API_KEY
-        }
         self.timeout = 5  # seconds
         self.retry_count = 3
         self.connected = False
+
+        # Local X,Y -> GPS: the reference point (GPS coords of the MASTER
+        # anchor at x=0, y=0) and degrees-per-meter factors are fixed
+        # 1 degree latitude ≈ 111,000 meters
+        # 1 degree longitude ≈ 111,000 * cos(latitude) meters
+        self._ref_lat = GPS_REFERENCE.get('lat', 11.0168)
+        self._ref_lng = GPS_REFERENCE.get('lng', 76.9558)
+        self._deg_per_m_lat = 1.0 / 111000
+        self._deg_per_m_lng = 1.0 / (111000 * math.cos(math.radians(self._ref_lat)))
+
+        # One keep-alive connection pool for all requests to the backend.
+        # Retries stay with the callers (_post_location backs off itself),
+        # so the adapter must not retry on its own. Requests from the
+        # worker and from the caller's thread each check out their own
+        # connection, so a slow location post never queues a health check
+        # or heartbeat behind it on the same socket.
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Content-Type': 'application/json',
+            'X-API-Key': GATEWAY_API_KEY
+        })
+        # Kept as the same mapping, so header changes apply to every call
+        self.headers = self.session.headers
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4,
+                              max_retries=Retry(total=0, read=False))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Locations and periodic heartbeats are posted by a background
+        # worker so a slow or unreachable backend never stalls the LoRa
+        # receive loop. Queue items are (kind, payload) tuples.
+        # Every fix goes to /api/location/update: it is the route that
+        # stores x/y, refreshes last_seen and raises live SOS alerts.
+        # A device has at most one ordinary fix waiting: a newer one takes
+        # its place in line. SOS fixes are queued as they come and are
+        # never dropped to make room.
+        self.sent_count = 0
+        self.queue_max = 64
+        self._items = collections.deque()  # [kind, payload] entries
+        self._pending = {}  # device_id -> its queued non-SOS entry
+        self._unfinished = 0
+        self._cond = threading.Condition()
+        self._worker = threading.Thread(target=self._drain, daemon=True)
+        self._worker.start()
     
     def check_connection(self):
         """Test if backend is reachable"""
         try:
-            response = requests.get(
+            response = self.session.get(
                 f"{self.base_url}/health",
                 timeout=3
             )
@@ -42,7 +93,7 @@ class BackendClient:
     
     def send_location(self, device_id, x, y, rssi_avg, sos_flag=False):
         """
-        Send trilaterated location to backend.
+        Queue a trilaterated location for sending to the backend.
         
         Args:
             device_id (str): Tourist device ID (e.g., "DEV001")
@@ -52,7 +103,8 @@ class BackendClient:
             sos_flag (bool): True if SOS button pressed
         
         Returns:
-            bool: True if successful, False otherwise
+            bool: True if queued, False if an older queued update had to be
+            dropped to make room
         """
         # Send raw X,Y coordinates (meters)
         payload = {
@@ -63,12 +115,109 @@ class BackendClient:
             "sos_flag": sos_flag
         }
         
+        return self._enqueue(("location", payload))
+
+    def queue_heartbeat(self, anchor_id="MASTER", stats=None):
+        """
+        Like send_heartbeat(), but posted by the background worker.
+
+        Returns:
+            bool: True if queued, False if an older queued update was dropped
+        """
+        return self._enqueue(("heartbeat", {
+            "anchor_id": anchor_id,
+            "stats": stats or {}
+        }))
+
+    def flush(self):
+        """Block until every queued update has been handled."""
+        with self._cond:
+            while self._unfinished:
+                self._cond.wait()
+
+    def close(self):
+        """Release the pooled backend connections."""
+        self.session.close()
+
+    def _enqueue(self, item):
+        """
+        Hand an update to the worker. A queued fix for the same device is
+        replaced by the newer one. When the queue is full the oldest
+        heartbeat, or else the oldest ordinary fix, is dropped.
+        """
+        kind, payload = item
+        coalesce = kind == "location" and not payload["sos_flag"]
+        with self._cond:
+            if coalesce:
+                entry = self._pending.get(payload["device_id"])
+                if entry is not None:
+                    entry[1] = payload
+                    return True
+            dropped = len(self._items) >= self.queue_max and self._drop_oldest()
+            entry = [kind, payload]
+            if coalesce:
+                self._pending[payload["device_id"]] = entry
+            self._items.append(entry)
+            self._unfinished += 1
+            self._cond.notify_all()
+        return not dropped
+
+    def _drop_oldest(self):
+        """
+        Make room in a full queue (caller holds _cond). Returns False if
+        only SOS fixes are queued: those are kept even past queue_max.
+        """
+        for wanted in ("heartbeat", "location"):
+            for i, (kind, payload) in enumerate(self._items):
+                if kind == wanted and not payload.get("sos_flag"):
+                    del self._items[i]
+                    if kind == "location":
+                        del self._pending[payload["device_id"]]
+                    self._unfinished -= 1
+                    print(f"[Backend] ⚠️ Send queue full, dropping oldest {kind}")
+                    return True
+        return False
+
+    def _drain(self):
+        """Worker thread: post queued updates one at a time."""
+        while True:
+            with self._cond:
+                while not self._items:
+                    self._cond.wait()
+                entry = self._items.popleft()
+                kind, payload = entry
+                if kind == "location" and self._pending.get(payload["device_id"]) is entry:
+                    del self._pending[payload["device_id"]]
+            try:
+                if kind == "location":
+                    if self._post_location(payload):
+                        self.sent_count += 1
+                else:
+                    self._post_heartbeat(payload)
+            finally:
+                with self._cond:
+                    self._unfinished -= 1
+                    if not self._unfinished:
+                        self._cond.notify_all()
+
+    def _post_location(self, payload):
+        """
+        POST one location payload, retrying with exponential backoff.
+        
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        x, y, device_id = payload["x"], payload["y"], payload["device_id"]
+        # NaN/inf can't go into JSON, and no retry will change that
+        if not (math.isfinite(x) and math.isfinite(y)):
+            print(f"[Backend] ❌ Dropping fix for {device_id}: non-finite position X={x}, Y={y}")
+            return False
+        body = _json_body(payload)
         for attempt in range(self.retry_count):
             try:
-                response = requests.post(
+                response = self.session.post(
                     f"{self.base_url}/api/location/update",
-                    json=payload,
-                    headers=self.headers,
+                    data=body,
                     timeout=self.timeout
                 )
                 
@@ -95,7 +244,7 @@ class BackendClient:
                 print(f"[Backend] ❌ Error: {e}")
             
             if attempt < self.retry_count - 1:
-                time.sleep(1)  # Wait before retry
+                time.sleep(0.5 * 2 ** attempt)  # Back off before retry
         
         return False
     
@@ -110,16 +259,17 @@ class BackendClient:
         Returns:
             bool: True if successful
         """
-        payload = {
+        return self._post_heartbeat({
             "anchor_id": anchor_id,
             "stats": stats or {}
-        }
-        
+        })
+
+    def _post_heartbeat(self, payload):
+        """POST one heartbeat payload. Returns True if acknowledged."""
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/api/gateway/heartbeat",
-                json=payload,
-                headers=self.headers,
+                data=_json_body(payload),
                 timeout=self.timeout
             )
             
@@ -156,10 +306,9 @@ class BackendClient:
             })
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/api/gateway/batch-update",
-                json={"locations": converted},
-                headers=self.headers,
+                data=_json_body({"locations": converted}),
                 timeout=self.timeout * 2
             )
             
@@ -185,22 +334,12 @@ class BackendClient:
         Returns:
             tuple: (latitude, longitude)
         """
-        # Reference point (GPS coords of MASTER anchor at x=0, y=0)
-        ref_lat = GPS_REFERENCE.get('lat', 11.0168)
-        ref_lng = GPS_REFERENCE.get('lng', 76.9558)
-        
-        # Approximate conversion factors
-        # 1 degree latitude ≈ 111,000 meters
-        # 1 degree longitude ≈ 111,000 * cos(latitude) meters
-        import math
-        meters_per_deg_lat = 111000
-        meters_per_deg_lng = 111000 * math.cos(math.radians(ref_lat))
-        
-        # Calculate offset
-        lat = ref_lat + (y / meters_per_deg_lat)
-        lng = ref_lng + (x / meters_per_deg_lng)
+        # Offset from the reference point (factors set up in __init__)
+        lat = self._ref_lat + y * self._deg_per_m_lat
+        lng = self._ref_lng + x * self._deg_per_m_lng
         
-        return round(lat, 6), round(lng, 6)
+        # Full float precision; the backend stores them as plain numbers
+        return lat, lng
     
     def register_anchor(self, anchor_id, name, x, y, gps_lat=None, gps_lng=None, is_master=False):
         """
@@ -227,10 +366,9 @@ class BackendClient:
             payload["gps_position"] = {"lat": gps_lat, "lng": gps_lng}
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/api/gateway/anchors",
-                json=payload,
-                headers=self.headers,
+                data=_json_body(payload),
                 timeout=self.timeout
             )
             
@@ -269,15 +407,16 @@ if __name__ == "__main__":
     
     # Test location (will fail if tourist not registered)
     print("\n3. Sending test location...")
-    result = client.send_location(
+    client.send_location(
         device_id="DEV001",
         x=50.0,
         y=30.0,
         rssi_avg=-65,
         sos_flag=False
     )
+    client.flush()
     
-    if result:
+    if client.sent_count:
         print("   ✅ Location sent successfully")
     else:
         print("   ⚠️ Location send failed (tourist may not be registered)")
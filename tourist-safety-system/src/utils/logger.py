@@ -2,44 +2,164 @@
 Simple Logger for LoRa Tourist Safety System
 Provides timestamped logging with different severity levels
 """
+import atexit
 import datetime
+import functools
 import os
+import queue
+import threading
+import time
 
 # Log file directory
 LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../logs')
 
+# Lines below LOG_LEVEL (environment, default INFO) are dropped before
+# any formatting is done
+LEVEL_ORDER = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+CURRENT_LEVEL = LEVEL_ORDER.get(os.environ.get('LOG_LEVEL', 'INFO').upper(), 20)
+
+# File output is handed to a writer thread so log() never waits on the SD
+# card. Lines are written in batches: once FLUSH_LINES are pending, or
+# FLUSH_INTERVAL seconds after the oldest pending one was logged.
+FLUSH_LINES = 50
+FLUSH_INTERVAL = 0.5  # seconds
+# Longest the interpreter waits at exit for pending lines to be written
+EXIT_FLUSH_TIMEOUT = 2.0  # seconds
+
+# Items are (date, line); a full queue drops the line rather than block
+_queue = queue.Queue(maxsize=10000)
+_writer = None
+_writer_lock = threading.Lock()
+_dir_checked = False
+
 def _ensure_log_dir():
-    """Create logs directory if it doesn't exist"""
-    if not os.path.exists(LOG_DIR):
-        os.makedirs(LOG_DIR)
+    """Create logs directory if it doesn't exist (checked once)"""
+    global _dir_checked
+    if not _dir_checked:
+        os.makedirs(LOG_DIR, exist_ok=True)
+        _dir_checked = True
+
+# Last formatted timestamp, the whole second it is for and that second's
+# date (which picks the log file)
+_ts_cached = ("", -1, None)
+
+# Wall clock for timestamps. Linux's coarse clock (tick resolution) is
+# plenty for whole seconds and cheaper to read; time.time() elsewhere.
+if hasattr(time, "CLOCK_REALTIME_COARSE"):
+    _wall_clock = functools.partial(time.clock_gettime, time.CLOCK_REALTIME_COARSE)
+else:
+    _wall_clock = time.time
 
 def _get_timestamp():
-    """Get current timestamp string"""
-    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    """
+    Get the current timestamp string and date (re-formatted once per
+    second). Both come from the same clock reading, so a line logged
+    around midnight goes to the file of the day its timestamp shows.
+    """
+    global _ts_cached
+    now = int(_wall_clock())
+    if now != _ts_cached[1]:
+        # A race between threads at most formats the same second twice
+        dt = datetime.datetime.fromtimestamp(now)
+        _ts_cached = (dt.strftime("%Y-%m-%d %H:%M:%S"), now, dt.date())
+    return _ts_cached[0], _ts_cached[2]
+
+def _write(fd, day, new_day, lines):
+    """
+    Append lines to the log file for new_day, reopening it on rollover.
+    The file is a raw O_APPEND descriptor: each batch is one encode and
+    one os.write(), with no buffered text layer in between.
+    """
+    try:
+        if new_day != day or fd is None:
+            if fd is not None:
+                os.close(fd)
+                fd = None
+            _ensure_log_dir()
+            fd = os.open(os.path.join(LOG_DIR, f"{new_day}.log"),
+                         os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        data = ''.join(lines).encode('utf-8')
+        while data:
+            data = data[os.write(fd, data):]
+    except Exception as e:
+        print(f"[WARNING] Could not write to log file: {e}")
+        if fd is not None:
+            os.close(fd)
+        fd = None
+    return fd, new_day
+
+def _drain():
+    """Writer thread: batch queued lines into the day's log file."""
+    fd, day = None, None
+    buf, buf_day, deadline = [], None, 0.0
+    while True:
+        timeout = max(0.0, deadline - time.monotonic()) if buf else None
+        try:
+            line_day, line = _queue.get(timeout=timeout)
+        except queue.Empty:
+            line_day = None
+        else:
+            if buf and line_day != buf_day:
+                # Date rolled over: the pending lines belong to the old file
+                fd, day = _write(fd, day, buf_day, buf)
+                for _ in buf:
+                    _queue.task_done()
+                buf = []
+            if not buf:
+                buf_day, deadline = line_day, time.monotonic() + FLUSH_INTERVAL
+            buf.append(line)
+            if len(buf) < FLUSH_LINES and time.monotonic() < deadline:
+                continue
+
+        fd, day = _write(fd, day, buf_day, buf)
+        for _ in buf:
+            _queue.task_done()
+        buf = []
+
+def _start_writer():
+    """Start the writer thread on first use."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_drain, daemon=True)
+            _writer.start()
+            atexit.register(flush, EXIT_FLUSH_TIMEOUT)
+
+def flush(timeout=None):
+    """
+    Block until every logged line has been written to the file, or until
+    timeout seconds have passed. Returns False if lines were still pending.
+    """
+    if _writer is None:
+        return True
+    with _queue.all_tasks_done:
+        return _queue.all_tasks_done.wait_for(lambda: not _queue.unfinished_tasks, timeout)
 
 def log(message, level="INFO", node_id="SYSTEM"):
     """
     Log a message with timestamp
-    
+
     Args:
         message: The message to log
         level: Log level (INFO, WARNING, ERROR, DEBUG)
         node_id: Identifier for which node is logging
     """
-    timestamp = _get_timestamp()
+    if LEVEL_ORDER.get(level, 20) < CURRENT_LEVEL:
+        return
+
+    timestamp, day = _get_timestamp()
     log_line = f"[{timestamp}] [{level}] [{node_id}] {message}"
-    
+
     # Print to console
     print(log_line)
-    
-    # Optionally write to file
+
+    # Queue for the log file
+    if _writer is None:
+        _start_writer()
     try:
-        _ensure_log_dir()
-        log_file = os.path.join(LOG_DIR, f"{datetime.date.today()}.log")
-        with open(log_file, 'a') as f:
-            f.write(log_line + "\n")
-    except Exception as e:
-        print(f"[WARNING] Could not write to log file: {e}")
+        _queue.put_nowait((day, log_line + "\n"))
+    except queue.Full:
+        pass
 
 def info(message, node_id="SYSTEM"):
     log(message, "INFO", node_id)
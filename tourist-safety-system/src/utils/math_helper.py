@@ -1,73 +1,174 @@
+import functools
 import math
 import numpy as np
-import sys
-import os
 
-# Add the project root to path so we can import config
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 from config.settings import ENV_FACTOR_N, RSSI_AT_1M
 
+# The radio reports RSSI as whole dBm, so distances for every integer reading
+# in [_RSSI_MIN, 0] are precomputed once (see _RSSI_LUT below the class)
+_RSSI_MIN = -200
+
 class MathEngine:
+    # 10 ** (d / (10 * N)) == exp(d * ln(10) / (10 * N)); N is fixed per deployment
+    _LN10_OVER_10N = math.log(10.0) / (10.0 * ENV_FACTOR_N)
+
     @staticmethod
     def rssi_to_distance(rssi):
         """
         Converts RSSI (dBm) to Distance (meters) using Log-Distance Path Loss Model.
         Formula: Distance = 10 ^ ((Measured_Power - RSSI) / (10 * N))
         """
+        # Integer readings (everything the radio produces) are a table hit
+        if rssi.__class__ is int and _RSSI_MIN <= rssi <= 0:
+            return _RSSI_LUT[rssi - _RSSI_MIN]
+
         # Constrain RSSI to prevent math errors (signals stronger than -10dBm are unlikely)
         if rssi > -10: rssi = -10
         
         # Calculate
-        exponent = (RSSI_AT_1M - rssi) / (10 * ENV_FACTOR_N)
-        distance = 10 ** exponent
+        distance = math.exp(MathEngine._LN10_OVER_10N * (RSSI_AT_1M - rssi))
         return round(distance, 2)
 
     @staticmethod
     def trilaterate(anchors_data):
         """
-        Calculates (x, y) based on 3 anchors and their distances.
+        Calculates (x, y) based on 3 or more anchors and their distances.
         
         Args:
-            anchors_data (list): A list of 3 dictionaries/tuples.
+            anchors_data (list): A list of 3 or more dictionaries/tuples.
             Format: [{'x': 0, 'y': 0, 'r': 10.5}, {'x': 100, 'y': 0, 'r': 50.2}, ...]
             
         Returns:
             tuple: (x, y) coordinates of the tourist.
         """
-        # We need exactly 3 circles for simple 2D trilateration
+        # We need at least 3 circles for 2D trilateration
         if len(anchors_data) < 3:
             return None
 
-        # Extract data for easier reading
-        x1, y1 = anchors_data[0]['x'], anchors_data[0]['y']
-        r1     = anchors_data[0]['r']
-        
-        x2, y2 = anchors_data[1]['x'], anchors_data[1]['y']
-        r2     = anchors_data[1]['r']
-        
-        x3, y3 = anchors_data[2]['x'], anchors_data[2]['y']
-        r3     = anchors_data[2]['r']
+        if len(anchors_data) > 3:
+            # Over-determined: subtracting the first circle equation from
+            # the others leaves A @ [x, y] = b, fitted by least squares
+            xy = np.array([(a['x'], a['y']) for a in anchors_data], dtype=np.float64)
+            r = np.array([a['r'] for a in anchors_data], dtype=np.float64)
+            A = 2.0 * (xy[1:] - xy[0])
+            b = (r[0] ** 2 - r[1:] ** 2) + np.sum(xy[1:] ** 2 - xy[0] ** 2, axis=1)
+            sol, _, rank, _ = np.linalg.lstsq(A, b, rcond=None)
+            if rank < 2:
+                # This happens if anchors are in a straight line (collinear)
+                print("ERROR: Anchors are collinear! Cannot trilaterate.")
+                return None
+            return round(float(sol[0]), 2), round(float(sol[1]), 2)
 
-        # --- The Math (Linear Algebra approach) ---
-        # We solve the intersection of circle equations using matrices: Ax = B
-        
-        A = -2 * x1 + 2 * x2
-        B = -2 * y1 + 2 * y2
-        C = r1**2 - r2**2 - x1**2 + x2**2 - y1**2 + y2**2
-        
-        D = -2 * x2 + 2 * x3
-        E = -2 * y2 + 2 * y3
-        F = r2**2 - r3**2 - x2**2 + x3**2 - y2**2 + y3**2
-
-        try:
-            # Cramer's Rule / Determinant solution
-            x = (C * E - F * B) / (E * A - B * D)
-            y = (C * D - A * F) / (B * D - A * E)
-            return round(x, 2), round(y, 2)
-        except ZeroDivisionError:
+        a0, a1, a2 = anchors_data[0], anchors_data[1], anchors_data[2]
+        result = trilaterate3(a0['x'], a0['y'], a0['r'],
+                              a1['x'], a1['y'], a1['r'],
+                              a2['x'], a2['y'], a2['r'])
+        if result is None:
             # This happens if anchors are in a straight line (collinear)
             print("ERROR: Anchors are collinear! Cannot trilaterate.")
             return None
+        return round(result[0], 2), round(result[1], 2)
+
+
+@functools.lru_cache(maxsize=8)
+def _trilat_geom(x0, y0, x1, y1, x2, y2):
+    """
+    The distance-independent part of trilaterate3() for one anchor layout.
+    Anchors are fixed per deployment, so this is worked out once and
+    cached. Returns the inverted 2x2 matrix (row-major) and the constant
+    terms of b, or None when the anchors are collinear.
+    """
+    A00 = 2.0 * (x1 - x0)
+    A01 = 2.0 * (y1 - y0)
+    A10 = 2.0 * (x2 - x0)
+    A11 = 2.0 * (y2 - y0)
+
+    det = A00 * A11 - A01 * A10
+    if det == 0:
+        return None
+    inv = 1.0 / det
+    k0 = x1 * x1 - x0 * x0 + y1 * y1 - y0 * y0
+    k1 = x2 * x2 - x0 * x0 + y2 * y2 - y0 * y0
+    return A11 * inv, -A01 * inv, -A10 * inv, A00 * inv, k0, k1
+
+
+def trilaterate3(x0, y0, r0, x1, y1, r1, x2, y2, r2):
+    """
+    Closed-form 3-anchor trilateration on plain floats.
+
+    Subtracting circle 0 from circles 1 and 2 leaves a 2x2 linear system
+    A @ [x, y] = b; A depends only on the anchors (see _trilat_geom), so
+    each fix is just b and a 2x2 matrix-vector product. Returns (x, y)
+    unrounded, or None when the anchors are collinear.
+    """
+    geom = _trilat_geom(x0, y0, x1, y1, x2, y2)
+    if geom is None:
+        return None
+    i00, i01, i10, i11, k0, k1 = geom
+    r0sq = r0 * r0
+    b0 = r0sq - r1 * r1 + k0
+    b1 = r0sq - r2 * r2 + k1
+    return i00 * b0 + i01 * b1, i10 * b0 + i11 * b1
+
+
+class FixedAnchorTrilaterator:
+    """
+    Trilateration specialised to one fixed three-anchor layout.
+
+    With the anchors constant, trilaterate3() reduces to a linear map of
+    the squared distances:  [x, y] = M @ [r0^2, r1^2, r2^2] + c.
+    M and c are derived once here; each fix is then six multiplies and
+    no division. Re-create it if the anchors are re-surveyed.
+    """
+
+    def __init__(self, anchor_xy):
+        """
+        Args:
+            anchor_xy: Three (x, y) anchor coordinates, in reading order.
+
+        Raises:
+            ValueError: If the anchors are collinear.
+        """
+        (x0, y0), (x1, y1), (x2, y2) = anchor_xy
+        geom = _trilat_geom(float(x0), float(y0), float(x1), float(y1),
+                            float(x2), float(y2))
+        if geom is None:
+            raise ValueError("Anchors are collinear")
+        i00, i01, i10, i11, k0, k1 = geom
+        # b0 = r0^2 - r1^2 + k0, b1 = r0^2 - r2^2 + k1, distributed into
+        # the rows of the inverted matrix
+        self._mx = (i00 + i01, -i00, -i01)
+        self._my = (i10 + i11, -i10, -i11)
+        self._cx = i00 * k0 + i01 * k1
+        self._cy = i10 * k0 + i11 * k1
+
+    def solve(self, r0, r1, r2):
+        """(x, y) for the three distances, unrounded."""
+        s0, s1, s2 = r0 * r0, r1 * r1, r2 * r2
+        mx, my = self._mx, self._my
+        return (mx[0] * s0 + mx[1] * s1 + mx[2] * s2 + self._cx,
+                my[0] * s0 + my[1] * s1 + my[2] * s2 + self._cy)
+
+    def locate(self, rssi):
+        """
+        RSSI readings straight to a position for this layout.
+
+        Args:
+            rssi (sequence): Three RSSI readings (dBm), in anchor order.
+
+        Returns:
+            tuple: ((x, y), list of distances in meters)
+        """
+        rssi = rssi.tolist() if hasattr(rssi, "tolist") else list(rssi)
+        distances = [MathEngine.rssi_to_distance(r) for r in rssi]
+        x, y = self.solve(*distances)
+        return (round(x, 2), round(y, 2)), distances
+
+
+# Distance for each integer RSSI from _RSSI_MIN to 0 dBm, index rssi - _RSSI_MIN.
+# Built through the float path of rssi_to_distance() so table hits return
+# exactly what the formula would.
+_RSSI_LUT = tuple(MathEngine.rssi_to_distance(float(r)) for r in range(_RSSI_MIN, 1))
 
 
 # Alias for backward compatibility
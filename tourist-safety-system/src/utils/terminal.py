@@ -0,0 +1,16 @@
+"""
+Terminal helpers for LoRa Tourist Safety System
+Console output shared by the node screens
+"""
+import os
+import sys
+
+
+def clear_screen():
+    # ANSI clear + cursor home; no need to spawn /usr/bin/clear. The Windows
+    # console only understands escapes once VT mode is on, so keep cls there.
+    if os.name == 'nt':
+        os.system('cls')
+    else:
+        sys.stdout.write("\x1b[2J\x1b[H")
+        sys.stdout.flush()